@@ -2,18 +2,46 @@
 音频处理模块 - 截取和生成音频片段
 """
 import os
+import heapq
+import json
 import subprocess
 import re
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 import tempfile
 import shutil
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from operator import itemgetter
+from parser import parse_time_to_seconds as time_to_seconds
+
+try:
+    import av
+except ImportError:  # 未安装 PyAV 时退回到 ffmpeg 子进程
+    av = None
 
 
 TEMP_AUDIO_DIR = Path(__file__).parent / 'temp_audio'
 AUDIO_BASE_DIR = Path(__file__).parent.parent / 'audio'
+AUDIO_INDEX_FILE = Path(__file__).parent / 'audio_index.json'  # 各季音频目录的扫描结果
 CLEANUP_AFTER_HOURS = 24  # 24小时后清理临时文件
+MAX_OPEN_AUDIO_FILES = 8  # 保持打开的音频文件数量（LRU）
+
+# 已打开的音频容器缓存，同一集的重复截取无需重新打开和探测文件
+_open_containers = OrderedDict()
+# 全局锁只保护缓存本身；读写容器时持有该文件的锁，不同集的截取可以同时进行
+_open_containers_lock = threading.Lock()
+# 音频文件路径 -> 使用该文件容器时持有的锁
+_container_locks = {}
+
+# season -> {episode: 音频文件路径}，每季首次查找时建立
+_season_audio = {}
+# 建立各季索引时该季目录的修改时间，未命中时据此判断是否需要重新扫描
+_season_audio_mtime = {}
+# 上次扫描保存在 AUDIO_INDEX_FILE 中的结果，首次需要时读取
+_saved_audio_index = None
+_season_audio_lock = threading.Lock()
 
 
 def ensure_temp_dir():
@@ -43,6 +71,115 @@ def parse_season_episode_from_filename(filename: str) -> Optional[Tuple[int, int
     return None
 
 
+def _audio_file_names(season: int, episode: int) -> Tuple[str, str]:
+    """音频文件的两种命名方式，按优先级排列"""
+    return (
+        f'小谢尔顿-S{season:02d}E{episode:02d}-音频.mp3',
+        f'小谢尔顿-S{season:02d}E{episode:02d}.mp3',
+    )
+
+
+def _season_audio_dir(season: int) -> Path:
+    """某一季的音频目录"""
+    return AUDIO_BASE_DIR / f'音频-S{season:02d}'
+
+
+def _dir_mtime(path: Path) -> Optional[float]:
+    """目录的修改时间，目录不存在时返回 None"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _scan_season_audio(season: int) -> Dict[int, str]:
+    """
+    扫描一季的音频目录
+    
+    Returns:
+        episode 到音频文件名的映射
+    """
+    episodes = {}
+    
+    try:
+        it = os.scandir(_season_audio_dir(season))
+    except OSError:
+        return episodes
+    
+    with it:
+        for entry in it:
+            season_episode = parse_season_episode_from_filename(entry.name)
+            if season_episode is None or season_episode[0] != season:
+                continue
+            
+            episode = season_episode[1]
+            names = _audio_file_names(season, episode)
+            if entry.name not in names:
+                continue
+            
+            # 两种命名同时存在时优先使用带 "-音频" 后缀的文件
+            current = episodes.get(episode)
+            if current is None or names.index(entry.name) < names.index(current):
+                episodes[episode] = entry.name
+    
+    return episodes
+
+
+def _load_saved_audio_index() -> dict:
+    """读取上次保存的扫描结果，文件不存在或损坏时返回空字典"""
+    try:
+        with open(AUDIO_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_audio_index(saved: dict):
+    """保存扫描结果，先写临时文件再替换，避免留下不完整的文件"""
+    temp_file = AUDIO_INDEX_FILE.with_suffix('.tmp')
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, ensure_ascii=False)
+        os.replace(temp_file, AUDIO_INDEX_FILE)
+    except OSError as e:
+        print(f"保存音频索引失败: {e}")
+
+
+def _load_season_audio(season: int):
+    """
+    建立一季的 episode -> 音频文件路径 索引
+    
+    季目录的修改时间与保存的结果一致时直接复用，否则重新扫描并保存。
+    季目录不存在时不建立索引，也不保存（季数来自请求，不能让无效的季数写入索引文件）。
+    调用方需持有 _season_audio_lock。
+    """
+    global _saved_audio_index
+    
+    season_dir = _season_audio_dir(season)
+    mtime = _dir_mtime(season_dir)
+    if mtime is None:
+        _season_audio.pop(season, None)
+        _season_audio_mtime.pop(season, None)
+        return
+    
+    if _saved_audio_index is None:
+        _saved_audio_index = _load_saved_audio_index()
+    
+    saved = _saved_audio_index.get(str(season))
+    if isinstance(saved, dict) and saved.get('mtime') == mtime:
+        names = {int(episode): name for episode, name in saved.get('episodes', {}).items()}
+    else:
+        names = _scan_season_audio(season)
+        _saved_audio_index[str(season)] = {
+            'mtime': mtime,
+            'episodes': {str(episode): name for episode, name in names.items()},
+        }
+        _save_audio_index(_saved_audio_index)
+    
+    _season_audio[season] = {episode: season_dir / name for episode, name in names.items()}
+    _season_audio_mtime[season] = mtime
+
+
 def find_audio_file(season: int, episode: int) -> Optional[Path]:
     """
     根据季和集数查找音频文件
@@ -54,17 +191,33 @@ def find_audio_file(season: int, episode: int) -> Optional[Path]:
     Returns:
         音频文件路径，如果不存在则返回 None
     """
-    # 尝试两种可能的路径
-    possible_paths = [
-        AUDIO_BASE_DIR / f'音频-S{season:02d}' / f'小谢尔顿-S{season:02d}E{episode:02d}-音频.mp3',
-        AUDIO_BASE_DIR / f'音频-S{season:02d}' / f'小谢尔顿-S{season:02d}E{episode:02d}.mp3',
-    ]
-    
-    for path in possible_paths:
-        if path.exists():
+    episodes = _season_audio.get(season)
+    if episodes is not None:
+        path = episodes.get(episode)
+        if path is not None:
             return path
     
-    return None
+    # 该季首次查找，或未命中且季目录发生变化后，才重新建立该季的索引
+    with _season_audio_lock:
+        if (season not in _season_audio
+                or _season_audio_mtime[season] != _dir_mtime(_season_audio_dir(season))):
+            _load_season_audio(season)
+        return _season_audio.get(season, {}).get(episode)
+
+
+def _list_temp_files(temp_dir: Path):
+    """
+    单次 os.scandir 遍历临时目录，返回所有 mp3 文件及其修改时间
+    
+    Returns:
+        (DirEntry, mtime) 列表
+    """
+    with os.scandir(temp_dir) as it:
+        return [
+            (entry, entry.stat(follow_symlinks=False).st_mtime)
+            for entry in it
+            if entry.name.endswith('.mp3')
+        ]
 
 
 def limit_file_count(max_files: int = 10):
@@ -74,41 +227,137 @@ def limit_file_count(max_files: int = 10):
         return
     
     # 获取所有文件及其修改时间
-    files = [(f, f.stat().st_mtime) for f in temp_dir.glob('*.mp3')]
-    
-    # 按修改时间排序（最新的在前）
-    files.sort(key=lambda x: x[1], reverse=True)
+    files = _list_temp_files(temp_dir)
     
-    # 如果文件数量超过限制，删除最早的
-    if len(files) > max_files:
-        files_to_delete = files[max_files:]
-        for file_path, _ in files_to_delete:
+    # 如果文件数量超过限制，只挑出最早的几个删除，无需对全部文件排序
+    excess = len(files) - max_files
+    if excess > 0:
+        files_to_delete = heapq.nsmallest(excess, files, key=itemgetter(1))
+        for entry, _ in files_to_delete:
             try:
-                file_path.unlink()
-                print(f"删除旧文件: {file_path.name}")
+                os.unlink(entry.path)
+                print(f"删除旧文件: {entry.name}")
             except Exception as e:
-                print(f"删除文件失败 {file_path}: {e}")
+                print(f"删除文件失败 {entry.path}: {e}")
+
+
+def _get_container_lock(audio_file: Path) -> threading.Lock:
+    """获取使用该音频文件容器时需持有的锁"""
+    with _open_containers_lock:
+        return _container_locks.setdefault(audio_file, threading.Lock())
 
 
-def time_to_seconds(time_str: str) -> float:
+def _get_container(audio_file: Path):
     """
-    将时间戳转换为秒数
+    获取已打开的音频容器，超出缓存数量时关闭最久未使用的
     
-    Args:
-        time_str: 时间戳，如 "0:18:38.72"
-        
-    Returns:
-        秒数，如 1118.72
+    调用方需持有该文件的锁；正在被其他线程使用的容器不会被关闭。
     """
-    parts = time_str.split(':')
-    hours = int(parts[0])
-    minutes = int(parts[1])
-    seconds_parts = parts[2].split('.')
-    seconds = int(seconds_parts[0])
-    milliseconds = int(seconds_parts[1]) if len(seconds_parts) > 1 else 0
+    with _open_containers_lock:
+        container = _open_containers.get(audio_file)
+        if container is not None:
+            _open_containers.move_to_end(audio_file)
+            return container
+    
+    # 打开文件需要读取和探测，不持有全局锁
+    container = av.open(str(audio_file))
     
-    total_seconds = hours * 3600 + minutes * 60 + seconds + milliseconds / 100.0
-    return total_seconds
+    with _open_containers_lock:
+        _open_containers[audio_file] = container
+        
+        for path in list(_open_containers):
+            if len(_open_containers) <= MAX_OPEN_AUDIO_FILES:
+                break
+            # 拿不到该文件的锁说明正在使用（包括当前文件），留到下次再关闭
+            lock = _container_locks[path]
+            if lock.acquire(blocking=False):
+                try:
+                    _open_containers.pop(path).close()
+                finally:
+                    lock.release()
+    
+    return container
+
+
+def _discard_container(audio_file: Path, container):
+    """关闭出错的容器，不再复用（调用方需持有该文件的锁）"""
+    with _open_containers_lock:
+        if _open_containers.get(audio_file) is container:
+            del _open_containers[audio_file]
+    container.close()
+
+
+def _remux_clip(audio_file: Path, output_path: Path, start_seconds: float, end_seconds: float) -> bool:
+    """使用 PyAV 在进程内截取音频片段，直接复制音频流，不做重新编码"""
+    with _get_container_lock(audio_file):
+        container = _get_container(audio_file)
+        try:
+            stream = container.streams.audio[0]
+            time_base = stream.time_base
+            container.seek(int(start_seconds / time_base), stream=stream)
+            
+            with av.open(str(output_path), 'w') as output:
+                out_stream = output.add_stream(template=stream)
+                first_pts = None
+                
+                for packet in container.demux(stream):
+                    # 跳过 demux 结束时的空包
+                    if packet.pts is None:
+                        continue
+                    packet_start = packet.pts * time_base
+                    if packet_start >= end_seconds:
+                        break
+                    if packet_start + packet.duration * time_base <= start_seconds:
+                        continue
+                    
+                    # 时间戳从 0 开始
+                    if first_pts is None:
+                        first_pts = packet.pts
+                    packet.pts -= first_pts
+                    if packet.dts is not None:
+                        packet.dts -= first_pts
+                    packet.stream = out_stream
+                    output.mux(packet)
+        except Exception:
+            # 出错的容器不再复用
+            _discard_container(audio_file, container)
+            raise
+    
+    return first_pts is not None
+
+
+def _run_ffmpeg(audio_file: Path, output_path: Path, start_seconds: float, duration: float) -> bool:
+    """使用 ffmpeg 子进程截取音频片段"""
+    cmd = [
+        'ffmpeg',
+        '-nostdin',
+        '-hide_banner',
+        '-loglevel', 'error',  # 只输出错误信息
+        '-ss', str(start_seconds),  # 放在 -i 之前，按索引直接定位，无需从头读取
+        '-i', str(audio_file),
+        '-t', str(duration),
+        '-c', 'copy',  # 直接复制音频流，不做重新编码
+        '-avoid_negative_ts', 'make_zero',  # 输出时间戳从 0 开始
+        '-map_metadata', '-1',  # 不复制源文件的元数据
+        '-fflags', '+bitexact',
+        '-y',  # 覆盖已存在的文件
+        str(output_path)
+    ]
+    
+    # 只收集 stderr（-loglevel error 下只有错误信息），失败时才解码
+    result = subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=30
+    )
+    
+    if result.returncode != 0:
+        print(f"ffmpeg 错误: {result.stderr.decode('utf-8', 'replace')}")
+        return False
+    
+    return True
 
 
 def extract_audio_clip(
@@ -150,37 +399,24 @@ def extract_audio_clip(
     # 确保临时目录存在
     temp_dir = ensure_temp_dir()
     
-    # 生成临时文件名
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_filename = f's{season:02d}e{episode:02d}_{timestamp}.mp3'
+    # 生成临时文件名：单调时钟加随机后缀，同一秒内的多个请求也不会重名
+    token = f'{time.monotonic_ns():016x}{os.urandom(3).hex()}'
+    output_filename = f's{season:02d}e{episode:02d}_{token}.mp3'
     output_path = temp_dir / output_filename
     
-    # 使用 ffmpeg 截取音频
+    # 截取音频：优先使用 PyAV 在进程内完成，未安装时调用 ffmpeg
     try:
-        cmd = [
-            'ffmpeg',
-            '-i', str(audio_file),
-            '-ss', str(start_seconds),
-            '-t', str(duration),
-            '-acodec', 'copy',  # 直接复制音频流，不做重新编码
-            '-y',  # 覆盖已存在的文件
-            str(output_path)
-        ]
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
+        if av is not None:
+            success = _remux_clip(audio_file, output_path, start_seconds, end_seconds)
+        else:
+            success = _run_ffmpeg(audio_file, output_path, start_seconds, duration)
         
-        if result.returncode == 0 and output_path.exists():
+        if success and output_path.exists():
             # 限制文件数量
             limit_file_count(max_files=10)
             # 返回相对于静态目录的路径
             return f'temp_audio/{output_filename}'
         else:
-            print(f"ffmpeg 错误: {result.stderr}")
             return None
             
     except subprocess.TimeoutExpired:
@@ -197,19 +433,16 @@ def cleanup_old_files():
     if not temp_dir.exists():
         return
     
-    cutoff_time = datetime.now() - timedelta(hours=CLEANUP_AFTER_HOURS)
+    cutoff_time = time.time() - CLEANUP_AFTER_HOURS * 3600
     deleted_count = 0
     
-    for file_path in temp_dir.glob('*.mp3'):
-        # 获取文件修改时间
-        file_time = datetime.fromtimestamp(file_path.stat().st_mtime)
-        
-        if file_time < cutoff_time:
+    for entry, mtime in _list_temp_files(temp_dir):
+        if mtime < cutoff_time:
             try:
-                file_path.unlink()
+                os.unlink(entry.path)
                 deleted_count += 1
             except Exception as e:
-                print(f"删除文件失败 {file_path}: {e}")
+                print(f"删除文件失败 {entry.path}: {e}")
     
     if deleted_count > 0:
         print(f"清理了 {deleted_count} 个旧文件")
@@ -3,14 +3,167 @@
 """
 import sqlite3
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
-from parser import parse_ass_file, parse_season_episode
+from parser import iter_ass_dialogues, parse_season_episode
+
+
+# 搜索语句在模块加载时生成，语句文本固定，可命中 sqlite3 的预编译语句缓存
+# 上下文（前后各一条）通过自连接相邻的 dialogue_index 一并取出
+_SEARCH_SQL = '''
+    SELECT d.dialogue_index, d.start_time, d.end_time,
+           d.chinese_text, d.english_text, f.filename, f.season, f.episode,
+           p.chinese_text || char(10) || p.english_text,
+           n.chinese_text || char(10) || n.english_text
+    FROM dialogues_fts fts
+    JOIN dialogues d ON fts.rowid = d.id
+    JOIN files f ON d.file_id = f.id
+    LEFT JOIN dialogues p
+        ON p.file_id = d.file_id AND p.dialogue_index = d.dialogue_index - 1
+    LEFT JOIN dialogues n
+        ON n.file_id = d.file_id AND n.dialogue_index = d.dialogue_index + 1
+    WHERE dialogues_fts MATCH ?
+    ORDER BY f.season, f.episode, d.dialogue_index
+    LIMIT ?
+'''
+
+# 载入内存的全部对话，顺序与搜索结果一致
+_LOAD_DIALOGUES_SQL = '''
+    SELECT d.file_id, d.dialogue_index, d.start_time, d.end_time,
+           d.chinese_text, d.english_text, f.filename, f.season, f.episode
+    FROM dialogues d
+    JOIN files f ON d.file_id = f.id
+    ORDER BY f.season, f.episode, d.dialogue_index
+'''
+
+# 按季汇总统计信息，构建索引及升级旧数据库时写入 index_stats
+_INSERT_STATS_SQL = '''
+    INSERT INTO index_stats (season, episode_count, episodes, total_files, total_dialogues)
+    SELECT season, COUNT(DISTINCT episode), GROUP_CONCAT(DISTINCT episode),
+           (SELECT COUNT(*) FROM files), (SELECT COUNT(*) FROM dialogues)
+    FROM files
+    GROUP BY season
+'''
+
+# 每个数据库文件对应的内存对话数据（按列存储）
+_memory_dialogues = {}
+_memory_dialogues_lock = threading.Lock()
+
+
+def _connect(db_file: str) -> sqlite3.Connection:
+    """打开数据库连接并应用 WAL 及缓存相关的 PRAGMA"""
+    conn = sqlite3.connect(db_file)
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA busy_timeout=5000;
+    ''')
+    return conn
+
+
+# 每个线程为每个数据库文件保留一个只读查询用的连接，避免每次请求重新打开
+_local = threading.local()
+
+# 已检查过表结构的数据库文件
+_upgraded_databases = set()
+_upgrade_lock = threading.Lock()
+
+
+def _get_connection(db_file: str) -> sqlite3.Connection:
+    """获取当前线程缓存的数据库连接"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    
+    conn = connections.get(db_file)
+    if conn is None:
+        conn = connections[db_file] = _connect(db_file)
+        _ensure_upgraded(db_file, conn)
+    return conn
+
+
+def _create_fts_table(cursor: sqlite3.Cursor):
+    """创建全文搜索索引表（FTS5），内容来自 dialogues 表"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS dialogues_fts USING fts5(
+            file_id UNINDEXED,
+            dialogue_index UNINDEXED,
+            chinese_text,
+            english_text,
+            content='dialogues',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+    ''')
+
+
+def _upgrade_database(conn: sqlite3.Connection):
+    """
+    升级旧版本构建的数据库，无需重新解析字幕文件
+    
+    旧版本的全文索引使用 unicode61 分词器，中文整句作为一个词，
+    按 trigram 的方式查询会搜不到结果，因此删除后按 dialogues 表重建；
+    旧版本只有 idx_file_id 索引，上下文自连接需逐条扫描同一文件的对话，改为复合索引；
+    旧版本没有 index_stats 表，按 files 表补齐统计信息。
+    """
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'files'")
+    if cursor.fetchone() is None:
+        # 尚未构建索引的空数据库，无需升级
+        cursor.close()
+        return
+    
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'dialogues_fts'")
+    row = cursor.fetchone()
+    if row is not None and 'trigram' not in row[0]:
+        print("升级全文搜索索引为 trigram 分词器...")
+        cursor.execute('DROP TABLE dialogues_fts')
+        _create_fts_table(cursor)
+        cursor.execute('INSERT INTO dialogues_fts(dialogues_fts) VALUES(\'rebuild\')')
+        conn.commit()
+    
+    cursor.execute('DROP INDEX IF EXISTS idx_file_id')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_dialogue ON dialogues(file_id, dialogue_index)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_season_episode ON files(season, episode)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_stats (
+            season INTEGER PRIMARY KEY,
+            episode_count INTEGER NOT NULL,
+            episodes TEXT NOT NULL,
+            total_files INTEGER NOT NULL,
+            total_dialogues INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('SELECT 1 FROM index_stats LIMIT 1')
+    if cursor.fetchone() is None:
+        print("生成统计信息...")
+        cursor.execute(_INSERT_STATS_SQL)
+    conn.commit()
+    
+    cursor.close()
+
+
+def _ensure_upgraded(db_file: str, conn: sqlite3.Connection):
+    """每个数据库文件在进程内只检查一次表结构"""
+    if db_file in _upgraded_databases:
+        return
+    
+    with _upgrade_lock:
+        if db_file not in _upgraded_databases:
+            _upgrade_database(conn)
+            _upgraded_databases.add(db_file)
 
 
 def init_database(db_file: str = 'subtitle_index.db'):
     """初始化数据库"""
-    conn = sqlite3.connect(db_file)
+    conn = _connect(db_file)
     cursor = conn.cursor()
     
     # 创建文件表
@@ -41,25 +194,34 @@ def init_database(db_file: str = 'subtitle_index.db'):
     ''')
     
     # 创建全文搜索索引（FTS5）
+    _create_fts_table(cursor)
+    
+    # 创建统计信息表（构建索引时写入，查询统计时直接读取）
     cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS dialogues_fts USING fts5(
-            file_id UNINDEXED,
-            dialogue_index UNINDEXED,
-            chinese_text,
-            english_text,
-            content='dialogues',
-            content_rowid='id'
+        CREATE TABLE IF NOT EXISTS index_stats (
+            season INTEGER PRIMARY KEY,
+            episode_count INTEGER NOT NULL,
+            episodes TEXT NOT NULL,
+            total_files INTEGER NOT NULL,
+            total_dialogues INTEGER NOT NULL
         )
     ''')
     
     # 创建普通索引
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_id ON dialogues(file_id)')
+    # (file_id, dialogue_index) 复合索引同时覆盖按文件查找和上下文自连接，取代旧的 idx_file_id
+    cursor.execute('DROP INDEX IF EXISTS idx_file_id')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_dialogue ON dialogues(file_id, dialogue_index)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_season_episode ON files(season, episode)')
     
     conn.commit()
     return conn
 
 
+def _parse_dialogues(file_path: Path) -> List[Tuple[str, str, str, str, str]]:
+    """解析单个 ASS 文件，返回对话元组列表（在子进程中执行）"""
+    return list(iter_ass_dialogues(file_path))
+
+
 def build_index(data_dir: str = 'data', db_file: str = 'subtitle_index.db'):
     """
     构建所有字幕文件的索引并存储到 SQLite
@@ -75,9 +237,10 @@ def build_index(data_dir: str = 'data', db_file: str = 'subtitle_index.db'):
     cursor = conn.cursor()
     
     # 清空现有数据（如果需要重新构建）
+    # 全文索引在批量写入完成后再重建，写入期间先删除
+    cursor.execute('DROP TABLE IF EXISTS dialogues_fts')
     cursor.execute('DELETE FROM dialogues')
     cursor.execute('DELETE FROM files')
-    cursor.execute('DELETE FROM dialogues_fts')
     conn.commit()
     
     # 获取所有 .ass 文件
@@ -85,49 +248,58 @@ def build_index(data_dir: str = 'data', db_file: str = 'subtitle_index.db'):
     
     print(f"找到 {len(ass_files)} 个字幕文件")
     
-    for i, file_path in enumerate(ass_files, 1):
-        print(f"处理文件 {i}/{len(ass_files)}: {file_path.name}")
+    # 在子进程中并行解析字幕文件，主进程只负责写入数据库
+    with ProcessPoolExecutor() as pool:
+        futures = [pool.submit(_parse_dialogues, file_path) for file_path in ass_files]
         
-        try:
-            # 解析文件名获取季集信息
-            season, episode = parse_season_episode(file_path.name)
-            
-            if season is None or episode is None:
-                print(f"  警告: 无法从文件名提取季集信息: {file_path.name}")
-                continue
-            
-            # 解析 ASS 文件
-            dialogues = parse_ass_file(file_path)
-            
-            # 插入文件记录
-            cursor.execute('''
-                INSERT INTO files (filename, file_path, season, episode)
-                VALUES (?, ?, ?, ?)
-            ''', (file_path.name, str(file_path), season, episode))
-            
-            file_id = cursor.lastrowid
+        # 所有文件在同一个事务中写入，避免每个文件提交一次带来的 fsync 开销
+        cursor.execute('BEGIN')
+        
+        for i, (file_path, future) in enumerate(zip(ass_files, futures), 1):
+            print(f"处理文件 {i}/{len(ass_files)}: {file_path.name}")
             
-            # 插入对话记录
-            for idx, dialogue in enumerate(dialogues):
+            try:
+                # 解析文件名获取季集信息
+                season, episode = parse_season_episode(file_path.name)
+                
+                if season is None or episode is None:
+                    print(f"  警告: 无法从文件名提取季集信息: {file_path.name}")
+                    continue
+                
+                # 等待子进程解析完成
+                dialogues = future.result()
+                
+                # 插入文件记录
                 cursor.execute('''
+                    INSERT INTO files (filename, file_path, season, episode)
+                    VALUES (?, ?, ?, ?)
+                ''', (file_path.name, str(file_path), season, episode))
+                
+                file_id = cursor.lastrowid
+                
+                # 批量插入对话记录
+                cursor.executemany('''
                     INSERT INTO dialogues (
                         file_id, dialogue_index, start_time, end_time,
                         chinese_text, english_text, raw_text
                     ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    file_id, idx, dialogue.start_time, dialogue.end_time,
-                    dialogue.chinese_text, dialogue.english_text, dialogue.raw_text
-                ))
-            
-            conn.commit()
+                ''', ((file_id, idx, *dialogue) for idx, dialogue in enumerate(dialogues)))
             
-        except Exception as e:
-            print(f"  错误处理文件 {file_path.name}: {e}")
-            continue
+            except Exception as e:
+                print(f"  错误处理文件 {file_path.name}: {e}")
+                continue
+    
+    conn.commit()
     
     # 重建 FTS 索引
     print("\n重建全文搜索索引...")
+    _create_fts_table(cursor)
     cursor.execute('INSERT INTO dialogues_fts(dialogues_fts) VALUES(\'rebuild\')')
+    
+    # 预先计算统计信息
+    print("生成统计信息...")
+    cursor.execute('DELETE FROM index_stats')
+    cursor.execute(_INSERT_STATS_SQL)
     conn.commit()
     
     print(f"\n索引构建完成！")
@@ -135,37 +307,28 @@ def build_index(data_dir: str = 'data', db_file: str = 'subtitle_index.db'):
 
 
 def get_statistics(db_file: str = 'subtitle_index.db') -> Dict[str, Any]:
-    """获取索引统计信息"""
-    conn = sqlite3.connect(db_file)
+    """获取索引统计信息（由 build_index 预先计算）"""
+    conn = _get_connection(db_file)
     cursor = conn.cursor()
     
-    # 总文件数
-    cursor.execute('SELECT COUNT(*) FROM files')
-    total_files = cursor.fetchone()[0]
-    
-    # 总对话数
-    cursor.execute('SELECT COUNT(*) FROM dialogues')
-    total_dialogues = cursor.fetchone()[0]
-    
-    # 统计每季的集数
     cursor.execute('''
-        SELECT season, COUNT(DISTINCT episode) as episode_count,
-               GROUP_CONCAT(DISTINCT episode)
-        FROM files
-        GROUP BY season
+        SELECT season, episode_count, episodes, total_files, total_dialogues
+        FROM index_stats
         ORDER BY season
     ''')
     
+    total_files = 0
+    total_dialogues = 0
     seasons = {}
     for row in cursor.fetchall():
-        season, episode_count, episodes_str = row
+        season, episode_count, episodes_str, total_files, total_dialogues = row
         episodes = [int(e) for e in episodes_str.split(',')]
         seasons[season] = {
             'episode_count': episode_count,
             'episodes': episodes
         }
     
-    conn.close()
+    cursor.close()
     
     return {
         'total_files': total_files,
@@ -174,6 +337,87 @@ def get_statistics(db_file: str = 'subtitle_index.db') -> Dict[str, Any]:
     }
 
 
+def load_dialogues(db_file: str = 'subtitle_index.db') -> Dict[str, Any]:
+    """
+    将全部对话按列载入内存，供短关键词搜索使用
+    
+    重建索引后 dialogues 的最大 id 会变化，此时自动重新载入。
+    
+    Args:
+        db_file: SQLite 数据库文件路径
+        
+    Returns:
+        列名到该列所有值的映射
+    """
+    conn = _get_connection(db_file)
+    version = conn.execute('SELECT MAX(id) FROM dialogues').fetchone()[0]
+    
+    with _memory_dialogues_lock:
+        dialogues = _memory_dialogues.get(db_file)
+        if dialogues is None or dialogues['version'] != version:
+            rows = conn.execute(_LOAD_DIALOGUES_SQL).fetchall()
+            columns = list(zip(*rows)) if rows else [()] * 9
+            (file_ids, dialogue_indexes, start_times, end_times,
+             chinese_texts, english_texts, filenames, seasons, episodes) = columns
+            
+            dialogues = {
+                'version': version,
+                'file_id': file_ids,
+                'dialogue_index': dialogue_indexes,
+                'start_time': start_times,
+                'end_time': end_times,
+                'chinese_text': chinese_texts,
+                'english_text': english_texts,
+                'filename': filenames,
+                'season': seasons,
+                'episode': episodes,
+                # 预先转为小写，匹配时不再逐条转换
+                'chinese_lower': [text.lower() for text in chinese_texts],
+                'english_lower': [text.lower() for text in english_texts],
+            }
+            _memory_dialogues[db_file] = dialogues
+    
+    return dialogues
+
+
+def _search_memory(dialogues: Dict[str, Any], query_lower: str, limit: int) -> List[Tuple]:
+    """在内存中逐条做子串匹配，返回与 _SEARCH_SQL 结构相同的结果行"""
+    file_ids = dialogues['file_id']
+    dialogue_indexes = dialogues['dialogue_index']
+    chinese_texts = dialogues['chinese_text']
+    english_texts = dialogues['english_text']
+    last = len(file_ids) - 1
+    
+    rows = []
+    for i, (chinese_lower, english_lower) in enumerate(
+        zip(dialogues['chinese_lower'], dialogues['english_lower'])
+    ):
+        # 与 SQL 的 LIMIT 一致：负数表示不限制
+        if len(rows) == limit:
+            break
+        if query_lower not in chinese_lower and query_lower not in english_lower:
+            continue
+        
+        # 上下文（前后各一条）即相邻位置上同一文件的对话
+        file_id = file_ids[i]
+        dialogue_index = dialogue_indexes[i]
+        context_before = None
+        context_after = None
+        if i > 0 and file_ids[i - 1] == file_id and dialogue_indexes[i - 1] == dialogue_index - 1:
+            context_before = f"{chinese_texts[i - 1]}\n{english_texts[i - 1]}"
+        if i < last and file_ids[i + 1] == file_id and dialogue_indexes[i + 1] == dialogue_index + 1:
+            context_after = f"{chinese_texts[i + 1]}\n{english_texts[i + 1]}"
+        
+        rows.append((
+            dialogue_index, dialogues['start_time'][i], dialogues['end_time'][i],
+            chinese_texts[i], english_texts[i], dialogues['filename'][i],
+            dialogues['season'][i], dialogues['episode'][i],
+            context_before, context_after
+        ))
+    
+    return rows
+
+
 def search_dialogues(
     query: str,
     db_file: str = 'subtitle_index.db',
@@ -190,86 +434,23 @@ def search_dialogues(
     Returns:
         搜索结果列表
     """
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    
     query_lower = query.lower().strip()
     
-    # 使用全文搜索
-    # FTS5 查询语法: column:term 或 "phrase"
-    # 使用两个查询：FTS 搜索和普通 LIKE 搜索
-    results_ids = set()
-    
-    # FTS5 全文搜索
-    cursor.execute('''
-        SELECT d.id
-        FROM dialogues_fts fts
-        JOIN dialogues d ON fts.rowid = d.id
-        WHERE dialogues_fts MATCH ?
-        LIMIT ?
-    ''', (f'"{query_lower}"', limit))
-    
-    for row in cursor.fetchall():
-        results_ids.add(row[0])
-    
-    # LIKE 模糊搜索
-    cursor.execute('''
-        SELECT id FROM dialogues
-        WHERE chinese_text LIKE ? OR english_text LIKE ?
-        LIMIT ?
-    ''', (f'%{query_lower}%', f'%{query_lower}%', limit))
-    
-    for row in cursor.fetchall():
-        results_ids.add(row[0])
-    
-    if not results_ids:
-        return []
-    
-    # 获取完整结果
-    placeholders = ','.join(['?'] * len(results_ids))
-    cursor.execute(f'''
-        SELECT d.file_id, d.dialogue_index, d.start_time, d.end_time,
-               d.chinese_text, d.english_text, f.filename, f.season, f.episode
-        FROM dialogues d
-        JOIN files f ON d.file_id = f.id
-        WHERE d.id IN ({placeholders})
-        ORDER BY f.season, f.episode, d.dialogue_index
-        LIMIT ?
-    ''', list(results_ids) + [limit])
+    if len(query_lower) >= 3:
+        # 使用全文搜索（trigram 分词器，支持中英文子串匹配）
+        conn = _get_connection(db_file)
+        cursor = conn.cursor()
+        cursor.execute(_SEARCH_SQL, ('"' + query_lower.replace('"', '""') + '"', limit))
+        rows = cursor.fetchall()
+        cursor.close()
+    else:
+        # trigram 的 MATCH 至少需要 3 个字符，更短的关键词在内存中逐条匹配
+        rows = _search_memory(load_dialogues(db_file), query_lower, limit)
     
     results = []
-    for row in cursor.fetchall():
-        file_id, dialogue_index, start_time, end_time, chinese_text, english_text, filename, season, episode = row
-        
-        # 获取上下文（前后各一条）
-        context_before = None
-        context_after = None
-        
-        # 获取前一条
-        cursor.execute('''
-            SELECT chinese_text, english_text
-            FROM dialogues
-            WHERE file_id = ? AND dialogue_index < ?
-            ORDER BY dialogue_index DESC
-            LIMIT 1
-        ''', (file_id, dialogue_index))
-        
-        prev_row = cursor.fetchone()
-        if prev_row:
-            context_before = f"{prev_row[0]}\n{prev_row[1]}"
-        
-        # 获取后一条
-        cursor.execute('''
-            SELECT chinese_text, english_text
-            FROM dialogues
-            WHERE file_id = ? AND dialogue_index > ?
-            ORDER BY dialogue_index ASC
-            LIMIT 1
-        ''', (file_id, dialogue_index))
-        
-        next_row = cursor.fetchone()
-        if next_row:
-            context_after = f"{next_row[0]}\n{next_row[1]}"
+    for row in rows:
+        (dialogue_index, start_time, end_time, chinese_text, english_text,
+         filename, season, episode, context_before, context_after) = row
         
         result = {
             'season': season,
@@ -286,7 +467,6 @@ def search_dialogues(
         
         results.append(result)
     
-    conn.close()
     return results
 
 
@@ -2,15 +2,32 @@
 FastAPI 后端主程序 - 提供字幕搜索 API
 """
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Optional
+from contextlib import asynccontextmanager
 import uvicorn
 import os
 
 
-app = FastAPI(title="字幕搜索系统", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时将对话载入内存，避免首次短关键词搜索时才加载"""
+    from indexer import load_dialogues
+    
+    # 尚未构建索引时不预加载，避免连接数据库时创建空的数据库文件
+    if os.path.exists('subtitle_index.db'):
+        try:
+            await run_in_threadpool(load_dialogues)
+        except Exception as e:
+            print(f"预加载对话失败: {e}")
+    
+    yield
+
+
+app = FastAPI(title="字幕搜索系统", version="1.0.0", lifespan=lifespan)
 
 # 配置 CORS
 app.add_middleware(
@@ -109,7 +126,8 @@ async def search(q: str, limit: int = 5000) -> SearchResponse:
     if not q or not q.strip():
         return SearchResponse(query=q, results=[], total=0)
     
-    results = search_dialogues(q, limit=limit)
+    # SQLite 查询是阻塞操作，放到线程池中执行，避免阻塞事件循环
+    results = await run_in_threadpool(search_dialogues, q, limit=limit)
     
     return SearchResponse(
         query=q,
@@ -124,7 +142,7 @@ async def stats():
     from indexer import get_statistics
     
     try:
-        stats_data = get_statistics()
+        stats_data = await run_in_threadpool(get_statistics)
         return stats_data
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"无法获取统计信息: {str(e)}")
@@ -182,14 +200,14 @@ async def generate_video(request: VideoClipRequest):
     Returns:
         视频片段 URL
     """
-    from video_processor import extract_video_clip, cleanup_old_files
+    from video_processor import extract_video_clip_async, cleanup_old_files
     
     try:
         # 清理旧文件
         cleanup_old_files()
         
-        # 截取视频
-        video_path = extract_video_clip(
+        # 截取视频（ffmpeg 以异步子进程运行，不阻塞事件循环）
+        video_path = await extract_video_clip_async(
             season=request.season,
             episode=request.episode,
             start_time=request.start_time,
@@ -1,15 +1,44 @@
 """
 字幕解析器 - 解析 ASS 文件格式，提取对白、时间戳和中英文内容
 """
+import codecs
 import re
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import Iterator, List, Dict, Optional, Tuple
 from dataclasses import dataclass
 
 
+# 提取所有 Dialogue 行（遵循 Events 的 Format 定义）：
+# Format: Layer, Start, End, Style, Actor, MarginL, MarginR, MarginV, Effect, Text
+# 允许任意 Style/Actor，并严格跳过 4 个 Margin 字段与 Effect 字段
+# 各字段均不匹配换行符，保证匹配不会跨行，回溯也被限制在单行之内
+_DIALOGUE_RE = re.compile(
+    r'^Dialogue:[ \t]*\d+,'                   # Layer
+    r'(\d+:\d+:\d+\.\d+),'                 # Start
+    r'(\d+:\d+:\d+\.\d+),'                 # End
+    r'[^,\n]*,'                                 # Style
+    r'[^,\n]*,'                                 # Actor
+    r'[^,\n]*,'                                 # MarginL
+    r'[^,\n]*,'                                 # MarginR
+    r'[^,\n]*,'                                 # MarginV
+    r'[^,\n]*,'                                 # Effect
+    r'(.*)$',                                   # Text (rest of line)
+    re.MULTILINE
+)
+
+# ASS 样式标记（{\fs14}, {\c&HFFFFFF&} 等）
+_BRACE_RE = re.compile(r'\{[^}]+\}')
+
+# 时间戳 H:MM:SS.cc
+_TIMESTAMP_RE = re.compile(r'(\d+):(\d+):(\d+)(?:\.(\d+))?')
+
+
 @dataclass
 class Dialogue:
     """对白数据结构"""
+    # 字段没有默认值，可直接声明 __slots__（兼容 3.8，无需 slots=True），实例不再携带 __dict__
+    __slots__ = ('start_time', 'end_time', 'chinese_text', 'english_text', 'raw_text')
+    
     start_time: str  # 开始时间戳 0:03:11.39
     end_time: str    # 结束时间戳 0:03:14.36
     chinese_text: str  # 中文对白
@@ -19,72 +48,71 @@ class Dialogue:
 
 def parse_time_to_seconds(time_str: str) -> float:
     """将时间戳转换为秒数"""
-    # 格式: 0:03:11.39 -> 191.39
-    parts = time_str.split(':')
-    hours = int(parts[0])
-    minutes = int(parts[1])
-    seconds_parts = parts[2].split('.')
-    seconds = int(seconds_parts[0])
-    milliseconds = int(seconds_parts[1]) if len(seconds_parts) > 1 else 0
+    # 格式: 0:03:11.39 -> 191.39，小数部分按位数换算（厘秒/毫秒均可）
+    match = _TIMESTAMP_RE.fullmatch(time_str.strip())
+    if match is None:
+        raise ValueError(f"无效的时间戳: {time_str}")
     
-    total_seconds = hours * 3600 + minutes * 60 + seconds + milliseconds / 100.0
-    return total_seconds
+    hours, minutes, seconds, fraction = match.groups()
+    total_seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    if not fraction:
+        return float(total_seconds)
+    
+    # 整数运算后只做一次除法，避免浮点累加误差
+    scale = 10 ** len(fraction)
+    return (total_seconds * scale + int(fraction)) / scale
 
 
-def parse_ass_file(file_path: Path) -> List[Dialogue]:
+def read_ass_content(file_path: Path) -> str:
     """
-    解析 ASS 文件，提取所有对话
+    读取并解码 ASS 文件内容
     
     Args:
         file_path: ASS 文件路径
         
     Returns:
-        对话列表
+        解码后的文件内容
     """
-    dialogues = []
+    # 只读取一次原始字节，根据 BOM 确定编码，否则依次尝试候选编码
+    raw = Path(file_path).read_bytes()
     
-    # 尝试多种编码
-    encodings = ['utf-8-sig', 'utf-8', 'utf-16', 'utf-16-le', 'utf-16-be', 'gb2312', 'gbk', 'gb18030']
-    content = None
+    if raw.startswith(codecs.BOM_UTF8):
+        encodings = ['utf-8-sig']
+    elif raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encodings = ['utf-16']
+    else:
+        # gb18030 兼容 gb2312/gbk
+        encodings = ['utf-8', 'gb18030', 'utf-16-le', 'utf-16-be']
     
     for encoding in encodings:
         try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                test_content = f.read()
-                # 验证内容是否包含有效的 ASS 文件标记
-                if '[Script Info]' in test_content or 'Dialogue:' in test_content:
-                    content = test_content
-                    break
+            content = raw.decode(encoding)
         except (UnicodeDecodeError, UnicodeError):
             continue
+        # 验证内容是否包含有效的 ASS 文件标记
+        if '[Script Info]' in content or 'Dialogue:' in content:
+            # 与文本模式读取一致，统一换行符
+            return content.replace('\r\n', '\n').replace('\r', '\n')
     
-    if content is None:
-        raise ValueError(f"无法解码文件: {file_path}")
-    
-    # 提取所有 Dialogue 行（遵循 Events 的 Format 定义）：
-    # Format: Layer, Start, End, Style, Actor, MarginL, MarginR, MarginV, Effect, Text
-    # 允许任意 Style/Actor，并严格跳过 4 个 Margin 字段与 Effect 字段
-    dialogue_regex = re.compile(
-        r'^Dialogue:\s*\d+,'                      # Layer
-        r'(\d+:\d+:\d+\.\d+),'                 # Start
-        r'(\d+:\d+:\d+\.\d+),'                 # End
-        r'[^,]*,'                                   # Style
-        r'[^,]*,'                                   # Actor
-        r'[^,]*,'                                   # MarginL
-        r'[^,]*,'                                   # MarginR
-        r'[^,]*,'                                   # MarginV
-        r'[^,]*,'                                   # Effect
-        r'(.*)$',                                   # Text (rest of line)
-        re.MULTILINE
-    )
-    matches = dialogue_regex.findall(content)
+    raise ValueError(f"无法解码文件: {file_path}")
+
+
+def iter_dialogues(content: str) -> Iterator[Tuple[str, str, str, str, str]]:
+    """
+    从 ASS 文件内容中逐条生成对话
     
-    for match in matches:
-        start_time, end_time, text = match
+    Args:
+        content: 解码后的 ASS 文件内容
+        
+    Returns:
+        (start_time, end_time, chinese_text, english_text, raw_text) 元组的迭代器
+    """
+    for match in _DIALOGUE_RE.finditer(content):
+        start_time, end_time, text = match.groups()
         
         # 清理文本中的格式标记
         # 移除 ASS 样式标记（{\fs14}, {\c&HFFFFFF&} 等）
-        clean_text = re.sub(r'\{[^}]+\}', '', text)
+        clean_text = _BRACE_RE.sub('', text)
         
         # 分离中英文（用 \N 分隔）
         parts = clean_text.split('\\N')
@@ -101,17 +129,36 @@ def parse_ass_file(file_path: Path) -> List[Dialogue]:
         if not chinese_text and english_text:
             chinese_text = english_text
         
-        dialogue = Dialogue(
-            start_time=start_time,
-            end_time=end_time,
-            chinese_text=chinese_text,
-            english_text=english_text,
-            raw_text=text
-        )
+        yield (start_time, end_time, chinese_text, english_text, text)
+
+
+def iter_ass_dialogues(file_path: Path) -> Iterator[Tuple[str, str, str, str, str]]:
+    """
+    解析 ASS 文件，逐条生成对话元组
+    
+    文件在调用时立即读取并解码（失败时直接抛出 ValueError），
+    对话则在迭代时按需生成，不构建中间列表。
+    
+    Args:
+        file_path: ASS 文件路径
         
-        dialogues.append(dialogue)
+    Returns:
+        (start_time, end_time, chinese_text, english_text, raw_text) 元组的迭代器
+    """
+    return iter_dialogues(read_ass_content(file_path))
+
+
+def parse_ass_file(file_path: Path) -> List[Dialogue]:
+    """
+    解析 ASS 文件，提取所有对话
     
-    return dialogues
+    Args:
+        file_path: ASS 文件路径
+        
+    Returns:
+        对话列表
+    """
+    return [Dialogue(*dialogue) for dialogue in iter_ass_dialogues(file_path)]
 
 
 def parse_season_episode(filename: str) -> Tuple[Optional[int], Optional[int]]:
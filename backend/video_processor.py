@@ -2,16 +2,146 @@
 视频处理模块 - 截取和生成视频片段
 """
 import os
+import asyncio
+import heapq
+import json
 import subprocess
 import re
+import threading
+import time
+import uuid
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Tuple
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from parser import parse_time_to_seconds as time_to_seconds
+
+try:
+    import av
+except ImportError:  # 未安装 PyAV 时流复制也交给 ffmpeg 子进程
+    av = None
 
 
 TEMP_VIDEO_DIR = Path(__file__).parent / 'temp_video'
 VIDEO_BASE_DIR = Path(__file__).parent.parent / 'video'
 CLEANUP_AFTER_HOURS = 24  # 24小时后清理临时文件
+MAX_OPEN_VIDEO_FILES = 4  # 保持打开的视频文件数量（LRU）
+
+# 视频文件名中的季集号，如 "S01.01.mkv"
+_SEASON_EP_RE = re.compile(r'S(\d+)\.(\d+)', re.ASCII)
+
+# 同时运行的 ffmpeg 进程数及每个进程的线程数，避免并发请求时线程数远超 CPU 核数
+# （一个进程截取多个片段时由各片段平分线程数）
+FFMPEG_MAX_CONCURRENT = int(os.environ.get('FFMPEG_MAX_CONCURRENT', max(1, (os.cpu_count() or 1) // 4)))
+FFMPEG_THREADS_PER_JOB = int(os.environ.get('FFMPEG_THREADS_PER_JOB', 4))
+# 事件循环 -> ffmpeg 并发信号量（asyncio.Semaphore 只能在创建它的事件循环中使用）
+_ffmpeg_semaphores = weakref.WeakKeyDictionary()
+# 片段只有几秒，libx264 默认使用最快的预设；设为 0 时改回 -preset fast 以换取画质
+FFMPEG_FAST_PRESET = os.environ.get('FFMPEG_FAST_PRESET', '1') != '0'
+
+# (season, episode) -> 视频文件路径，只缓存找到的文件，未找到时下次重新检查
+_video_files = {}
+
+# 已打开的视频容器缓存，同一集的重复截取无需重新打开和探测文件
+_open_containers = OrderedDict()
+# 全局锁只保护缓存本身；读写容器时持有该文件的锁，不同集的截取可以同时进行
+_open_containers_lock = threading.Lock()
+# 视频文件路径 -> 使用该文件容器时持有的锁
+_container_locks = {}
+
+# 视频文件路径 -> (修改时间, 关键帧时间数组)，磁盘上的副本保存在 TEMP_VIDEO_DIR/.keyframes
+_keyframe_indexes = {}
+# 视频文件路径 -> 建立该文件索引时持有的锁，不同的视频文件可以同时建立索引
+_keyframe_locks = {}
+_keyframe_locks_guard = threading.Lock()
+
+# 临时目录中已生成的片段：文件名 -> 修改时间，首次清理时扫描一次目录建立，之后随生成/删除更新
+_temp_files = {}
+# 按修改时间排列的最小堆 (mtime, 文件名)；片段被再次使用或删除后旧条目留在堆中，弹出时跳过
+_temp_heap = []
+_temp_index_loaded = False
+_temp_index_lock = threading.Lock()
+
+# 源视频已是 iOS 可播放的编码时直接流复制，不再转码
+STREAM_COPY_H264_PROFILES = {'Constrained Baseline', 'Baseline', 'Main'}
+STREAM_COPY_MAX_H264_LEVEL = 40  # ffprobe 以 40 表示 level 4.0
+
+# libx264 的预设参数
+if FFMPEG_FAST_PRESET:
+    X264_PRESET_ARGS = (
+        '-preset', 'ultrafast',      # 最快预设，几秒的片段几乎没有码率损失
+        '-tune', 'zerolatency',      # 不做前向分析，减少缓冲的帧
+        '-g', '48',
+        '-x264-params', 'scenecut=0:ref=1',
+    )
+else:
+    X264_PRESET_ARGS = ('-preset', 'fast')
+
+# 转码时可用的 H.264 编码器，按优先级排列：硬件编码器优先，libx264 兜底
+# 每项为 (放在输入之前的设备参数, 编码参数)
+VIDEO_ENCODERS = {
+    'h264_nvenc': (
+        (),
+        ('-c:v', 'h264_nvenc', '-profile:v', 'baseline', '-preset', 'p4', '-rc', 'vbr', '-cq', '23'),
+    ),
+    'h264_qsv': (
+        (),
+        ('-c:v', 'h264_qsv', '-profile:v', 'baseline', '-preset', 'fast'),
+    ),
+    'h264_vaapi': (
+        ('-vaapi_device', '/dev/dri/renderD128'),
+        ('-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi', '-profile:v', 'constrained_baseline'),
+    ),
+    'h264_videotoolbox': (
+        (),
+        ('-c:v', 'h264_videotoolbox', '-profile:v', 'baseline'),
+    ),
+    'libx264': (
+        (),
+        (
+            '-c:v', 'libx264',           # 视频编码
+            '-profile:v', 'baseline',    # H.264 baseline profile，iOS 兼容
+            '-level', '3.0',             # H.264 level，iOS 兼容
+            *X264_PRESET_ARGS,
+        ),
+    ),
+}
+
+# 截取片段的 ffmpeg 命令中固定不变的部分，生成命令时只拼接时间、路径等可变参数
+_FFMPEG_GLOBAL_ARGS = (
+    '-hide_banner',
+    '-loglevel', 'error',            # 只输出错误信息
+)
+# 每路输入：缩小探测范围，跳过默认数秒的流分析
+_FFMPEG_INPUT_ARGS = (
+    '-probesize', '32k',
+    '-analyzeduration', '0',
+    '-fflags', '+fastseek',
+)
+# 源编码已兼容时直接复制音视频流（不解码、不编码），起点对齐到关键帧
+_FFMPEG_COPY_ARGS = (
+    '-c', 'copy',
+    '-avoid_negative_ts', 'make_zero',   # 输出时间戳从 0 开始
+    '-movflags', '+faststart',
+)
+# 转码时视频编码参数之后的部分
+_FFMPEG_TRANSCODE_ARGS = (
+    '-c:a', 'aac',               # 强制转码为 AAC
+    '-ar', '48000',              # 音频采样率 48kHz
+    '-b:a', '192k',              # 音频比特率
+    '-ac', '2',                  # 降混为立体声（iOS 不支持 5.1）
+    '-movflags', '+faststart',   # 快速启动，边下载边播放
+    '-avoid_negative_ts', 'make_zero',   # 输出时间戳从 0 开始
+)
+# 每个输出文件路径之前的部分
+_FFMPEG_OUTPUT_ARGS = (
+    '-max_muxing_queue_size', '9999',    # 多路输入同时编码时避免复用队列溢出而失败
+    '-f', 'mp4',                     # 输出到临时文件，扩展名不是 .mp4，需指定格式
+    '-y',                            # 覆盖已存在的文件
+)
 
 
 def ensure_temp_dir():
@@ -30,13 +160,9 @@ def parse_season_episode_from_filename(filename: str) -> Optional[Tuple[int, int
     Returns:
         (season, episode) 元组，如 (1, 1)
     """
-    pattern = r'S(\d+)\.(\d+)'
-    match = re.search(pattern, filename)
-    
+    match = _SEASON_EP_RE.search(filename)
     if match:
-        season = int(match.group(1))
-        episode = int(match.group(2))
-        return (season, episode)
+        return (int(match.group(1)), int(match.group(2)))
     
     return None
 
@@ -52,166 +178,776 @@ def find_video_file(season: int, episode: int) -> Optional[Path]:
     Returns:
         视频文件路径，如果不存在则返回 None
     """
+    video_path = _video_files.get((season, episode))
+    if video_path is not None:
+        return video_path
+    
     # 文件名格式: S{season}.{episode}.mkv
     video_path = VIDEO_BASE_DIR / f'S{season:02d}.{episode:02d}.mkv'
     
     if video_path.exists():
+        _video_files[(season, episode)] = video_path
         return video_path
     
     return None
 
 
-def time_to_seconds(time_str: str) -> float:
+def invalidate_video_cache():
+    """清空视频文件路径、编码探测、关键帧索引和已打开容器的缓存（视频文件被替换或删除后调用）"""
+    _video_files.clear()
+    _probe_codecs_cached.cache_clear()
+    _keyframe_indexes.clear()
+    
+    with _open_containers_lock:
+        while _open_containers:
+            _, container = _open_containers.popitem()
+            container.close()
+
+
+@lru_cache(maxsize=64)
+def _probe_codecs_cached(path: str, mtime: float) -> Optional[Dict[str, dict]]:
+    """按 (路径, 修改时间) 缓存 ffprobe 结果，文件变化后自动重新探测"""
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,profile,level,channels',
+        '-of', 'json',
+        path
+    ]
+    
+    try:
+        result = subprocess.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=10
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"ffprobe 执行失败: {e}")
+        return None
+    
+    if result.returncode != 0:
+        print(f"ffprobe 错误: {result.stderr.decode('utf-8', 'replace')}")
+        return None
+    
+    try:
+        streams = json.loads(result.stdout).get('streams', [])
+    except ValueError:
+        return None
+    
+    # 只保留第一路视频流和第一路音频流，与截取时的 -map 0:v:0 / 0:a:0 对应
+    codecs = {}
+    for stream in streams:
+        codecs.setdefault(stream.get('codec_type'), stream)
+    return codecs
+
+
+def probe_codecs(video_file: Path) -> Optional[Dict[str, dict]]:
     """
-    将时间戳转换为秒数
+    探测视频文件的编码信息（结果会被缓存）
     
     Args:
-        time_str: 时间戳，如 "0:18:38.72"
+        video_file: 视频文件路径
         
     Returns:
-        秒数，如 1118.72
+        {'video': {...}, 'audio': {...}} 形式的流信息，探测失败返回 None
     """
-    parts = time_str.split(':')
-    hours = int(parts[0])
-    minutes = int(parts[1])
-    seconds_parts = parts[2].split('.')
-    seconds = int(seconds_parts[0])
-    milliseconds = int(seconds_parts[1]) if len(seconds_parts) > 1 else 0
+    try:
+        mtime = video_file.stat().st_mtime
+    except OSError:
+        return None
     
-    total_seconds = hours * 3600 + minutes * 60 + seconds + milliseconds / 100.0
-    return total_seconds
+    return _probe_codecs_cached(str(video_file), mtime)
 
 
-def limit_file_count(max_files: int = 10):
-    """限制临时文件数量，保留最新的文件"""
-    temp_dir = ensure_temp_dir()
-    if not temp_dir.exists():
-        return
+def _can_stream_copy(video_file: Path) -> bool:
+    """源视频是否已是 iOS 兼容的 H.264 + 立体声 AAC（首次调用会同步运行 ffprobe）"""
+    codecs = probe_codecs(video_file)
+    if not codecs or 'video' not in codecs or 'audio' not in codecs:
+        return False
+    
+    video = codecs['video']
+    audio = codecs['audio']
+    return (
+        video.get('codec_name') == 'h264'
+        and video.get('profile') in STREAM_COPY_H264_PROFILES
+        and 0 < video.get('level', 0) <= STREAM_COPY_MAX_H264_LEVEL
+        and audio.get('codec_name') == 'aac'
+        and audio.get('channels') == 2
+    )
+
+
+def _scan_keyframes(video_file: Path) -> List[float]:
+    """读取第一路视频流的全部数据包（不解码），返回关键帧时间（秒，升序）"""
+    if av is not None:
+        with av.open(str(video_file)) as container:
+            stream = container.streams.video[0]
+            return sorted(
+                float(packet.pts * packet.time_base)
+                for packet in container.demux(stream)
+                if packet.pts is not None and packet.is_keyframe
+            )
+    
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        str(video_file)
+    ]
+    result = subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        timeout=300
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', 'replace'))
+    
+    keyframes = []
+    for line in result.stdout.decode('utf-8', 'replace').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+def keyframe_index(video_file: Path) -> Optional[array]:
+    """
+    视频文件的关键帧时间索引
+    
+    首次使用时读取整个文件建立并保存到 TEMP_VIDEO_DIR/.keyframes，
+    之后直接加载；视频文件修改后重新建立。
+    
+    Args:
+        video_file: 视频文件路径
+        
+    Returns:
+        关键帧时间（秒，升序）数组，建立失败返回 None
+    """
+    try:
+        mtime = video_file.stat().st_mtime
+    except OSError:
+        return None
     
-    # 获取所有文件及其修改时间
-    files = [(f, f.stat().st_mtime) for f in temp_dir.glob('*.mp4')]
+    cached = _keyframe_indexes.get(video_file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
     
-    # 按修改时间排序（最新的在前）
-    files.sort(key=lambda x: x[1], reverse=True)
+    # 全局锁只用于取得该文件的锁，读取整个文件期间不阻塞其他视频文件
+    with _keyframe_locks_guard:
+        lock = _keyframe_locks.setdefault(video_file, threading.Lock())
     
-    # 如果文件数量超过限制，删除最早的
-    if len(files) > max_files:
-        files_to_delete = files[max_files:]
-        for file_path, _ in files_to_delete:
+    with lock:
+        cached = _keyframe_indexes.get(video_file)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        
+        # 索引文件的第一个元素为建立索引时视频文件的修改时间
+        index_file = TEMP_VIDEO_DIR / '.keyframes' / f'{video_file.name}.idx'
+        keyframes = None
+        try:
+            data = array('d')
+            with open(index_file, 'rb') as f:
+                data.frombytes(f.read())
+            if data and data[0] == mtime:
+                keyframes = data[1:]
+        except (OSError, ValueError):
+            pass
+        
+        if keyframes is None:
             try:
-                file_path.unlink()
-                print(f"删除旧视频文件: {file_path.name}")
+                keyframes = array('d', _scan_keyframes(video_file))
             except Exception as e:
-                print(f"删除文件失败 {file_path}: {e}")
+                print(f"建立关键帧索引失败 {video_file}: {e}")
+                return None
+            
+            # 先写临时文件再替换，避免留下不完整的索引
+            temp_file = index_file.with_suffix('.tmp')
+            try:
+                index_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(temp_file, 'wb') as f:
+                    f.write((array('d', [mtime]) + keyframes).tobytes())
+                os.replace(temp_file, index_file)
+            except OSError as e:
+                print(f"保存关键帧索引失败: {e}")
+        
+        _keyframe_indexes[video_file] = (mtime, keyframes)
+        return keyframes
 
 
-def extract_video_clip(
+def _snap_to_keyframes(keyframes: array, start_seconds: float, end_seconds: float) -> Tuple[float, float]:
+    """起点向前对齐到最近的关键帧，终点向后对齐到最近的关键帧（之后没有关键帧时保持不变）"""
+    i = bisect_right(keyframes, start_seconds) - 1
+    start_seconds = keyframes[max(i, 0)]
+    
+    j = bisect_left(keyframes, end_seconds)
+    if j < len(keyframes):
+        end_seconds = keyframes[j]
+    
+    return start_seconds, end_seconds
+
+
+def _encoder_works(encoder: str) -> bool:
+    """用一小段测试画面试编码，确认编码器在本机确实可用（编译进 ffmpeg 不代表有对应硬件）"""
+    device_args, encode_args = VIDEO_ENCODERS[encoder]
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        *device_args,
+        '-f', 'lavfi', '-i', 'color=size=256x256:rate=25:duration=0.2',
+        *encode_args,
+        '-frames:v', '1', '-f', 'null', '-',
+    ]
+    
+    try:
+        # 只关心是否成功，输出全部丢弃
+        result = subprocess.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=10
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    
+    return result.returncode == 0
+
+
+@lru_cache(maxsize=1)
+def get_video_encoder() -> str:
+    """
+    检测可用的 H.264 编码器（只检测一次）
+    
+    Returns:
+        VIDEO_ENCODERS 中第一个可用的硬件编码器，都不可用时返回 'libx264'
+    """
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=10
+        )
+        available = result.stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"检测视频编码器失败: {e}")
+        return 'libx264'
+    
+    for encoder in VIDEO_ENCODERS:
+        if encoder == 'libx264':
+            break
+        if re.search(rf'\b{encoder}\b', available) and _encoder_works(encoder):
+            print(f"使用硬件视频编码器: {encoder}")
+            return encoder
+    
+    return 'libx264'
+
+
+def _list_temp_files(temp_dir: Path):
+    """
+    单次 os.scandir 遍历临时目录，返回所有 mp4 文件及其修改时间
+    
+    Returns:
+        (DirEntry, mtime) 列表
+    """
+    with os.scandir(temp_dir) as it:
+        return [
+            (entry, entry.stat(follow_symlinks=False).st_mtime)
+            for entry in it
+            if entry.name.endswith('.mp4')
+        ]
+
+
+def _load_temp_index():
+    """首次使用时扫描临时目录，建立片段索引（调用方需持有 _temp_index_lock）"""
+    global _temp_index_loaded
+    
+    if _temp_index_loaded:
+        return
+    
+    for entry, mtime in _list_temp_files(ensure_temp_dir()):
+        _temp_files[entry.name] = mtime
+    _temp_heap[:] = [(mtime, name) for name, mtime in _temp_files.items()]
+    heapq.heapify(_temp_heap)
+    _temp_index_loaded = True
+
+
+def _track_temp_file(filename: str, mtime: float):
+    """记录新生成或再次使用的片段"""
+    with _temp_index_lock:
+        _load_temp_index()
+        _temp_files[filename] = mtime
+        heapq.heappush(_temp_heap, (mtime, filename))
+        
+        # 过期条目过多时按当前索引重建堆
+        if len(_temp_heap) > 2 * len(_temp_files) + 64:
+            _temp_heap[:] = [(mtime, name) for name, mtime in _temp_files.items()]
+            heapq.heapify(_temp_heap)
+
+
+def _oldest_temp_file():
+    """
+    最早的片段，顺带丢弃堆顶的过期条目（调用方需持有 _temp_index_lock）
+    
+    Returns:
+        (mtime, 文件名)，没有片段时返回 None
+    """
+    while _temp_heap:
+        mtime, name = _temp_heap[0]
+        if _temp_files.get(name) == mtime:
+            return mtime, name
+        heapq.heappop(_temp_heap)
+    return None
+
+
+def _delete_temp_file(name: str) -> bool:
+    """删除片段并移出索引，堆中的条目随之过期（调用方需持有 _temp_index_lock）"""
+    del _temp_files[name]
+    
+    file_path = TEMP_VIDEO_DIR / name
+    try:
+        os.unlink(file_path)
+        return True
+    except FileNotFoundError:
+        # 已在外部被删除
+        return False
+    except Exception as e:
+        print(f"删除文件失败 {file_path}: {e}")
+        return False
+
+
+def limit_file_count(max_files: int = 10):
+    """限制临时文件数量，保留最新的文件"""
+    with _temp_index_lock:
+        _load_temp_index()
+        
+        # 如果文件数量超过限制，从堆顶依次删除最早的
+        while len(_temp_files) > max_files:
+            _, name = _oldest_temp_file()
+            if _delete_temp_file(name):
+                print(f"删除旧视频文件: {name}")
+
+
+def _get_ffmpeg_semaphore() -> asyncio.Semaphore:
+    """当前事件循环的 ffmpeg 并发信号量"""
+    loop = asyncio.get_running_loop()
+    semaphore = _ffmpeg_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(FFMPEG_MAX_CONCURRENT)
+        _ffmpeg_semaphores[loop] = semaphore
+    return semaphore
+
+
+def _build_video_clip_cmd(
+    video_file: Path,
+    clips: List[Tuple[float, float, Path]],
+    stream_copy: bool
+) -> List[str]:
+    """
+    生成截取视频片段的 ffmpeg 命令，多个片段由同一个 ffmpeg 进程一次截取
+    
+    每个片段作为一路独立的输入（各自按索引定位），映射到各自的输出文件，
+    片段之间相隔较远时也无需解码中间的内容。
+    转码时首次调用会同步运行编码器检测，异步环境中应放到线程池中执行。
+    
+    Args:
+        video_file: 视频文件路径
+        clips: (开始秒数, 持续秒数, 输出路径) 列表
+        stream_copy: 是否直接复制音视频流（源编码已兼容 iOS）
+    """
+    if stream_copy:
+        device_args, input_args, output_args = (), _FFMPEG_INPUT_ARGS, _FFMPEG_COPY_ARGS
+    else:
+        # 优先使用硬件编码器，不可用时退回 libx264
+        device_args, encode_args = VIDEO_ENCODERS[get_video_encoder()]
+        # 每个片段各有一个解码器和一个编码器，线程数按片段平分，
+        # 整个进程的线程数不超过 FFMPEG_THREADS_PER_JOB
+        threads = ('-threads', str(max(1, FFMPEG_THREADS_PER_JOB // len(clips))))
+        input_args = _FFMPEG_INPUT_ARGS + threads
+        output_args = encode_args + _FFMPEG_TRANSCODE_ARGS + threads
+    
+    cmd = ['ffmpeg', *device_args, *_FFMPEG_GLOBAL_ARGS]
+    
+    # 输入参数：-ss 放在 -i 之前按索引直接定位（转码时 ffmpeg 会解码到精确的起点，
+    # 无需再分两段 seek）
+    for start_seconds, duration, _ in clips:
+        cmd.extend(input_args)
+        cmd.extend(('-ss', str(start_seconds), '-t', str(duration), '-i', str(video_file)))
+    
+    for input_index, (_, _, output_path) in enumerate(clips):
+        # 与探测的流一致，且不带字幕流；没有音轨的源文件（只会走转码）只输出视频
+        cmd.extend(('-map', f'{input_index}:v:0', '-map', f'{input_index}:a:0?'))
+        cmd.extend(output_args)
+        cmd.extend(_FFMPEG_OUTPUT_ARGS)
+        cmd.append(str(output_path))
+    
+    return cmd
+
+
+def _get_container_lock(video_file: Path) -> threading.Lock:
+    """获取使用该视频文件容器时需持有的锁"""
+    with _open_containers_lock:
+        return _container_locks.setdefault(video_file, threading.Lock())
+
+
+def _get_container(video_file: Path):
+    """
+    获取已打开的视频容器，超出缓存数量时关闭最久未使用的
+    
+    调用方需持有该文件的锁；正在被其他线程使用的容器不会被关闭。
+    """
+    with _open_containers_lock:
+        container = _open_containers.get(video_file)
+        if container is not None:
+            _open_containers.move_to_end(video_file)
+            return container
+    
+    # 打开文件需要读取和探测，不持有全局锁
+    container = av.open(str(video_file))
+    
+    with _open_containers_lock:
+        _open_containers[video_file] = container
+        
+        for path in list(_open_containers):
+            if len(_open_containers) <= MAX_OPEN_VIDEO_FILES:
+                break
+            # 拿不到该文件的锁说明正在使用（包括当前文件），留到下次再关闭
+            lock = _container_locks[path]
+            if lock.acquire(blocking=False):
+                try:
+                    _open_containers.pop(path).close()
+                finally:
+                    lock.release()
+    
+    return container
+
+
+def _discard_container(video_file: Path, container):
+    """关闭出错的容器，不再复用（调用方需持有该文件的锁）"""
+    with _open_containers_lock:
+        if _open_containers.get(video_file) is container:
+            del _open_containers[video_file]
+    container.close()
+
+
+def _remux_clip(container, output_path: Path, start_seconds: float, end_seconds: float) -> bool:
+    """
+    从已打开的容器中复制一个片段的第一路视频流和音频流
+    
+    与 ffmpeg 的 -ss（放在 -i 之前）加 -c copy 相同：起点对齐到起点之前最近的关键帧。
+    """
+    video_stream = container.streams.video[0]
+    audio_stream = container.streams.audio[0]
+    # 四舍五入，起点恰为关键帧时间时不会因浮点误差定位到前一个关键帧
+    container.seek(round(start_seconds / video_stream.time_base), stream=video_stream)
+    
+    with av.open(str(output_path), 'w', format='mp4', options={'movflags': 'faststart'}) as output:
+        out_streams = {
+            video_stream.index: output.add_stream(template=video_stream),
+            audio_stream.index: output.add_stream(template=audio_stream),
+        }
+        # 片段起点（秒），即第一个视频关键帧的时间
+        clip_start = None
+        # 已越过片段终点的流，两路都越过后结束
+        finished = set()
+        
+        for packet in container.demux(video_stream, audio_stream):
+            # 跳过 demux 结束时的空包
+            if packet.pts is None or packet.stream.index in finished:
+                continue
+            time_base = packet.time_base
+            
+            if packet.stream.index == video_stream.index:
+                # 按解码顺序判断，有 B 帧时也不会漏掉结束前的帧
+                packet_time = (packet.dts if packet.dts is not None else packet.pts) * time_base
+                if clip_start is None:
+                    if not packet.is_keyframe:
+                        continue
+                    clip_start = packet_time
+            else:
+                packet_time = packet.pts * time_base
+                if clip_start is None or packet_time < clip_start:
+                    continue
+            
+            if packet_time >= end_seconds:
+                finished.add(packet.stream.index)
+                if len(finished) == 2:
+                    break
+                continue
+            
+            # 时间戳从 0 开始
+            offset = int(clip_start / time_base)
+            packet.pts -= offset
+            if packet.dts is not None:
+                packet.dts -= offset
+            packet.stream = out_streams[packet.stream.index]
+            output.mux(packet)
+    
+    return clip_start is not None
+
+
+def _remux_clips(video_file: Path, clips: List[Tuple[float, float, Path]]) -> bool:
+    """使用 PyAV 在进程内截取多个片段，直接复制音视频流，不启动 ffmpeg 进程"""
+    with _get_container_lock(video_file):
+        container = _get_container(video_file)
+        try:
+            return all(
+                _remux_clip(container, output_path, start_seconds, start_seconds + duration)
+                for start_seconds, duration, output_path in clips
+            )
+        except Exception:
+            # 出错的容器不再复用
+            _discard_container(video_file, container)
+            raise
+
+
+async def _run_ffmpeg(cmd: List[str], timeout: float) -> bool:
+    """以异步子进程运行 ffmpeg"""
+    # 超出并发上限的请求在此排队
+    async with _get_ffmpeg_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        finally:
+            # 超时或请求被取消时结束 ffmpeg 进程
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    
+    if process.returncode != 0:
+        print(f"ffmpeg 错误: {stderr.decode('utf-8', 'replace')}")
+        return False
+    
+    return True
+
+
+async def extract_many_clips_async(
     season: int,
     episode: int,
-    start_time: str,
-    end_time: str,
-    padding: float = 2.0
-) -> Optional[str]:
+    ranges: List[Tuple[str, str]],
+    padding: float = 2.0,
+    force: bool = False
+) -> List[Optional[str]]:
     """
-    从视频文件中截取片段
+    从同一集中截取多个片段，尚未生成的片段由一个 ffmpeg 进程一次截取
+    （ffmpeg 以异步子进程运行，等待期间不占用线程）
     
     Args:
         season: 季数
         episode: 集数
-        start_time: 开始时间戳，如 "0:18:38.72"
-        end_time: 结束时间戳，如 "0:18:40.48"
+        ranges: (开始时间戳, 结束时间戳) 列表，如 [("0:18:38.72", "0:18:40.48")]
         padding: 前后额外添加的秒数，默认2秒
+        force: 为 True 时忽略已生成的相同片段，重新截取
         
     Returns:
-        生成的视频文件路径（相对于静态目录），失败返回 None
+        与 ranges 一一对应的视频文件路径（相对于静态目录），失败的片段为 None
     """
     # 查找视频文件
     video_file = find_video_file(season, episode)
     if not video_file:
-        return None
-    
-    # 转换时间戳
-    start_seconds = time_to_seconds(start_time)
-    end_seconds = time_to_seconds(end_time)
+        return [None] * len(ranges)
     
-    # 添加前后缓冲时间
-    start_seconds = max(0, start_seconds - padding)
-    end_seconds = end_seconds + padding
+    # 转换时间戳，添加前后缓冲时间
+    clip_ranges = [
+        (max(0, time_to_seconds(start_time) - padding), time_to_seconds(end_time) + padding)
+        for start_time, end_time in ranges
+    ]
     
-    # 计算持续时间
-    duration = end_seconds - start_seconds
+    # 首次探测源文件编码、建立关键帧索引会同步运行，放到线程池中避免阻塞事件循环
+    loop = asyncio.get_running_loop()
+    stream_copy = await loop.run_in_executor(None, _can_stream_copy, video_file)
+    if stream_copy:
+        # 流复制的片段实际从关键帧开始，起止时间先对齐到关键帧，
+        # 落在同一段关键帧间隔内的请求复用同一个片段
+        keyframes = await loop.run_in_executor(None, keyframe_index, video_file)
+        if keyframes:
+            clip_ranges = [
+                _snap_to_keyframes(keyframes, start_seconds, end_seconds)
+                for start_seconds, end_seconds in clip_ranges
+            ]
     
     # 确保临时目录存在
     temp_dir = ensure_temp_dir()
     
-    # 生成临时文件名
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_filename = f's{season:02d}e{episode:02d}_{timestamp}.mp4'
-    output_path = temp_dir / output_filename
+    results = []
+    # 需要截取的片段：(结果下标列表, 开始秒数, 持续秒数, 输出文件名, 临时文件路径)
+    pending = []
+    # 输出文件名 -> pending 中的片段，对齐关键帧后相同的片段只截取一次
+    pending_by_name = {}
+    for start_seconds, end_seconds in clip_ranges:
+        # 文件名由季集和起止时间（厘秒）决定，相同片段只截取一次
+        output_filename = (
+            f's{season:02d}e{episode:02d}_'
+            f'{round(start_seconds * 100):08d}_{round(end_seconds * 100):08d}.mp4'
+        )
+        output_path = temp_dir / output_filename
+        
+        if not force and output_path.exists():
+            # 更新修改时间，按修改时间清理时常用的片段会被保留
+            now = time.time()
+            os.utime(output_path, (now, now))
+            _track_temp_file(output_filename, now)
+            results.append(f'temp_video/{output_filename}')
+            continue
+        
+        clip = pending_by_name.get(output_filename)
+        if clip is not None:
+            clip[0].append(len(results))
+            results.append(None)
+            continue
+        
+        # 先写入临时文件再改名，并发的相同请求不会读到写了一半的文件
+        partial_path = temp_dir / f'{output_filename}.{uuid.uuid4().hex}.part'
+        clip = ([len(results)], start_seconds, end_seconds - start_seconds, output_filename, partial_path)
+        pending.append(clip)
+        pending_by_name[output_filename] = clip
+        results.append(None)
+    
+    if not pending:
+        return results
     
-    # 使用 ffmpeg 截取视频
+    # 截取视频
     try:
-        cmd = [
-            'ffmpeg',
-            '-i', str(video_file),
-            '-ss', str(start_seconds),
-            '-t', str(duration),
-            '-c:v', 'libx264',           # 视频编码
-            '-profile:v', 'baseline',    # H.264 baseline profile，iOS 兼容
-            '-level', '3.0',             # H.264 level，iOS 兼容
-            '-preset', 'fast',           # 快速编码
-            '-c:a', 'aac',               # 强制转码为 AAC
-            '-ar', '48000',              # 音频采样率 48kHz
-            '-b:a', '192k',              # 音频比特率
-            '-ac', '2',                  # 降混为立体声（iOS 不支持 5.1）
-            '-movflags', '+faststart',   # 快速启动，边下载边播放
-            '-y',                        # 覆盖已存在的文件
-            str(output_path)
-        ]
+        clips = [(start_seconds, duration, partial_path) for _, start_seconds, duration, _, partial_path in pending]
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
+        success = None
+        if stream_copy and av is not None:
+            # 无需转码时用 PyAV 在进程内复制，省去启动 ffmpeg 进程和重新探测文件的开销
+            try:
+                # 与 ffmpeg 进程一样占用一个并发名额
+                async with _get_ffmpeg_semaphore():
+                    success = await loop.run_in_executor(None, _remux_clips, video_file, clips)
+            except Exception as e:
+                print(f"PyAV 截取视频失败，改用 ffmpeg: {e}")
+        
+        if not success:
+            # 转码时每个 ffmpeg 进程最多截取 FFMPEG_THREADS_PER_JOB 个片段（每个片段至少一个线程），
+            # 其余片段由其他进程截取，各自占用一个并发名额
+            batch_size = len(clips) if stream_copy else max(1, FFMPEG_THREADS_PER_JOB)
+            batches = [clips[i:i + batch_size] for i in range(0, len(clips), batch_size)]
+            cmds = [
+                await loop.run_in_executor(None, _build_video_clip_cmd, video_file, batch, stream_copy)
+                for batch in batches
+            ]
+            # 等待全部进程结束后再处理异常，避免清理临时文件时还有进程在写入
+            outcomes = await asyncio.gather(
+                *(_run_ffmpeg(cmd, timeout=60 * len(batch)) for cmd, batch in zip(cmds, batches)),
+                return_exceptions=True
+            )
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+            success = all(outcomes)
         
-        if result.returncode == 0 and output_path.exists():
-            # 限制文件数量
-            limit_file_count(max_files=10)
-            # 返回相对于静态目录的路径
-            return f'temp_video/{output_filename}'
+        if success:
+            for indexes, _, _, output_filename, partial_path in pending:
+                if partial_path.exists():
+                    output_path = temp_dir / output_filename
+                    os.replace(partial_path, output_path)
+                    _track_temp_file(output_filename, output_path.stat().st_mtime)
+                    # 返回相对于静态目录的路径
+                    for index in indexes:
+                        results[index] = f'temp_video/{output_filename}'
+            # 限制文件数量（至少保留本次生成的全部片段）
+            limit_file_count(max_files=max(10, len(ranges)))
         else:
-            print(f"ffmpeg 错误: {result.stderr}")
-            return None
+            # 源文件可能已被替换或删除，下次请求重新查找和探测
+            invalidate_video_cache()
             
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         print("ffmpeg 超时")
-        return None
     except Exception as e:
         print(f"截取视频时出错: {e}")
-        return None
+    finally:
+        # 删除失败时残留的临时文件
+        for _, _, _, _, partial_path in pending:
+            if partial_path.exists():
+                partial_path.unlink()
+    
+    return results
+
+
+async def extract_video_clip_async(
+    season: int,
+    episode: int,
+    start_time: str,
+    end_time: str,
+    padding: float = 2.0,
+    force: bool = False
+) -> Optional[str]:
+    """
+    从视频文件中截取片段（ffmpeg 以异步子进程运行，等待期间不占用线程）
+    
+    Args:
+        season: 季数
+        episode: 集数
+        start_time: 开始时间戳，如 "0:18:38.72"
+        end_time: 结束时间戳，如 "0:18:40.48"
+        padding: 前后额外添加的秒数，默认2秒
+        force: 为 True 时忽略已生成的相同片段，重新截取
+        
+    Returns:
+        生成的视频文件路径（相对于静态目录），失败返回 None
+    """
+    results = await extract_many_clips_async(season, episode, [(start_time, end_time)], padding, force)
+    return results[0]
+
+
+def extract_many_clips(
+    season: int,
+    episode: int,
+    ranges: List[Tuple[str, str]],
+    padding: float = 2.0,
+    force: bool = False
+) -> List[Optional[str]]:
+    """
+    从同一集中截取多个片段（extract_many_clips_async 的同步版本，供脚本等非异步环境调用）
+    
+    参数和返回值同 extract_many_clips_async。
+    """
+    return asyncio.run(extract_many_clips_async(season, episode, ranges, padding, force))
+
+
+def extract_video_clip(
+    season: int,
+    episode: int,
+    start_time: str,
+    end_time: str,
+    padding: float = 2.0,
+    force: bool = False
+) -> Optional[str]:
+    """
+    从视频文件中截取片段（extract_video_clip_async 的同步版本，供脚本等非异步环境调用）
+    
+    参数和返回值同 extract_video_clip_async。
+    """
+    return asyncio.run(extract_video_clip_async(season, episode, start_time, end_time, padding, force))
 
 
 def cleanup_old_files():
     """清理旧的临时文件"""
-    temp_dir = ensure_temp_dir()
-    if not temp_dir.exists():
-        return
-    
-    cutoff_time = datetime.now() - timedelta(hours=CLEANUP_AFTER_HOURS)
+    cutoff_time = time.time() - CLEANUP_AFTER_HOURS * 3600
     deleted_count = 0
     
-    for file_path in temp_dir.glob('*.mp4'):
-        # 获取文件修改时间
-        file_time = datetime.fromtimestamp(file_path.stat().st_mtime)
+    with _temp_index_lock:
+        _load_temp_index()
         
-        if file_time < cutoff_time:
-            try:
-                file_path.unlink()
+        # 堆顶即最早的片段，早于截止时间的依次删除
+        while True:
+            oldest = _oldest_temp_file()
+            if oldest is None or oldest[0] >= cutoff_time:
+                break
+            if _delete_temp_file(oldest[1]):
                 deleted_count += 1
-            except Exception as e:
-                print(f"删除文件失败 {file_path}: {e}")
     
     if deleted_count > 0:
         print(f"清理了 {deleted_count} 个旧视频文件")